@@ -0,0 +1,74 @@
+# Helpers for resuming a crawl after it has been stopped/killed part way
+# through (see middlewares.CheckpointMiddleware).
+
+import os
+import json
+
+from scrapy.extensions.feedexport import FileFeedStorage
+
+
+# Signal sent just before a domain is journaled as done. Components that
+# buffer output (e.g. the page text and result store pipelines) should write
+# it out (durably) when they receive it, since a restarted crawl skips the
+# domain. If a handler raises an error, the domain isn't journaled as done.
+flush_outputs = object()
+
+class CrawlJournal:
+    """
+    Append-only JSON-lines journal of crawl progress, with one line per event:
+    - {"event": "item", "domain": ..., "url": ...} when an item is exported
+    - {"event": "done", "domain": ...} when every request for a domain has
+      been processed
+    A domain that has items but no "done" line was only partially crawled.
+    """
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.done_domains, self.partial_domains = self.load(fpath)
+        os.makedirs(os.path.dirname(fpath) or '.', exist_ok=True)
+        self.file = open(fpath, 'a')
+
+    @staticmethod
+    def load(fpath):
+        done_domains, seen_domains = set(), set()
+        if os.path.exists(fpath):
+            with open(fpath) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line can be incomplete if the crawl was killed
+                        continue
+                    seen_domains.add(record['domain'])
+                    if record['event'] == 'done':
+                        done_domains.add(record['domain'])
+        return done_domains, seen_domains - done_domains
+
+    def log_item(self, domain, url):
+        self._write({'event': 'item', 'domain': domain, 'url': url})
+
+    def log_done(self, domain):
+        self.done_domains.add(domain)
+        self.partial_domains.discard(domain)
+        self._write({'event': 'done', 'domain': domain}, sync=True)
+
+    def close(self):
+        self.file.close()
+
+    def _write(self, record, sync=False):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+
+class UnbufferedFileFeedStorage(FileFeedStorage):
+    """
+    Same as Scrapy's FileFeedStorage, but without Python's write buffer, so
+    items that have been exported (and journaled) are not lost if the crawl
+    process is killed.
+    """
+    def open(self, spider):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        return open(self.path, self.write_mode, buffering=0)
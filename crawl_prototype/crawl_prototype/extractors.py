@@ -0,0 +1,177 @@
+# Declarative extraction of item fields from the HTML of a webpage.
+#
+# Each item class has a spec (field -> rule), and the rules of a spec are
+# compiled into an Extractor that gets every field in a single walk over the
+# document tree that Scrapy has already parsed (with lxml), instead of running
+# one or more XPath queries per field. Adding a field to a spec does not add
+# another pass over the document.
+#
+# Rules:
+# ('first_text', tag)         - text of the first <tag> element
+# ('meta', name)              - content of the first <meta name="name"> element
+# ('links', kind)             - set of <a href> links that match LINK_PATTERNS[kind]
+# ('footer_lines', pattern)   - lines of the <footer> text that match pattern
+# ('page_text', None)         - visible text of the page, excluding
+#                               BOILERPLATE_TAGS
+
+import re
+import unicodedata
+
+from lxml import etree
+
+# local:
+from crawl_prototype import items
+
+
+# If a pattern has a group, the group is used as the value (or the text of the
+# link if the group is empty), otherwise the whole href is used.
+LINK_PATTERNS = {
+    'tel': re.compile(r'^tel:(.*)$', flags=re.S),
+    'mailto': re.compile(r'^mailto:([^?]*)', flags=re.I),
+    'social': re.compile(r'facebook|instagram|twitter|youtube|linkedin'),
+}
+BOILERPLATE_TAGS = {'script', 'style', 'noscript', 'template', 'nav', 'header',
+                    'footer', 'form'}
+FOOTER_LINE_SEPARATOR = re.compile(r'\n|\t|\r')
+# \xa9 is unicode for the copyright symbol
+COPYRIGHT_PATTERN = re.compile(r'^.*(\xa9|copyright).*$', flags=re.I)
+
+
+GENERIC_WEBPAGE_SPEC = {
+    'text': ('page_text', None),
+    'phone_numbers': ('links', 'tel'),
+    'email_addresses': ('links', 'mailto'),
+    'social_links': ('links', 'social'),
+}
+ABOUT_US_SPEC = {
+    **GENERIC_WEBPAGE_SPEC,
+}
+HOMEPAGE_SPEC = {
+    **GENERIC_WEBPAGE_SPEC,
+    'title': ('first_text', 'title'),
+    'author': ('meta', 'author'),
+    'description': ('meta', 'description'),
+    'copyright': ('footer_lines', COPYRIGHT_PATTERN),
+}
+ITEM_SPECS = {
+    items.GenericWebpageItem: GENERIC_WEBPAGE_SPEC,
+    items.AboutUsItem: ABOUT_US_SPEC,
+    items.HomepageItem: HOMEPAGE_SPEC,
+}
+
+
+class Extractor:
+    def __init__(self, spec):
+        self.first_text_fields = {}  # tag -> field
+        self.meta_fields = {}  # meta name -> field
+        self.link_fields = {}  # field -> pattern
+        self.footer_fields = {}  # field -> pattern
+        self.page_text_fields = []
+        for field, (kind, arg) in spec.items():
+            if kind == 'first_text':
+                self.first_text_fields[arg] = field
+            elif kind == 'meta':
+                self.meta_fields[arg] = field
+            elif kind == 'links':
+                self.link_fields[field] = LINK_PATTERNS[arg]
+            elif kind == 'footer_lines':
+                self.footer_fields[field] = arg
+            elif kind == 'page_text':
+                self.page_text_fields.append(field)
+            else:
+                raise ValueError(f"Unknown extractor rule '{kind}' for field '{field}'")
+        self.collect_text = bool(self.page_text_fields or self.footer_fields)
+
+    def extract(self, root):
+        """
+        Returns a dict of field -> value for every field in the spec.
+        """
+        fields = {field: None for field in self.first_text_fields.values()}
+        fields.update({field: None for field in self.meta_fields.values()})
+        fields.update({field: set() for field in self.link_fields})
+        page_text_parts, footer_text_parts = [], []
+        body_depth = boilerplate_depth = footer_depth = 0
+
+        def add_text(text):
+            if text:
+                if body_depth and not boilerplate_depth:
+                    page_text_parts.append(text)
+                if footer_depth:
+                    footer_text_parts.append(text)
+
+        # Comments/processing instructions only have their own events, but
+        # their tail is still part of the text
+        for event, el in etree.iterwalk(root, events=('start', 'end', 'comment', 'pi')):
+            tag = el.tag
+            if event in ('comment', 'pi'):
+                if self.collect_text:
+                    add_text(el.tail)
+            elif event == 'start':
+                if tag == 'body':
+                    body_depth += 1
+                elif tag in BOILERPLATE_TAGS:
+                    boilerplate_depth += 1
+                if tag == 'footer':
+                    footer_depth += 1
+
+                if tag in self.first_text_fields:
+                    field = self.first_text_fields[tag]
+                    if fields[field] is None:
+                        fields[field] = el.text
+                elif tag == 'meta':
+                    field = self.meta_fields.get(el.get('name'))
+                    if field is not None and fields[field] is None:
+                        fields[field] = el.get('content')
+                elif tag == 'a' and self.link_fields:
+                    href = el.get('href')
+                    if href is not None:
+                        self._add_links(fields, href, el)
+
+                if self.collect_text:
+                    add_text(el.text)
+            else:
+                if tag == 'body':
+                    body_depth -= 1
+                elif tag in BOILERPLATE_TAGS:
+                    boilerplate_depth -= 1
+                if tag == 'footer':
+                    footer_depth -= 1
+
+                # The tail comes after the end of the element
+                if self.collect_text:
+                    add_text(el.tail)
+
+        if self.page_text_fields:
+            text_parts = (x.strip() for x in page_text_parts)
+            clean_text = '\n'.join(x for x in text_parts if x)  # remove redundant newlines
+            cleaner_text = unicodedata.normalize('NFKD', clean_text)  # remove decoding mistakes
+            fields.update({field: cleaner_text for field in self.page_text_fields})
+        if self.footer_fields:
+            footer_lines = [x for x in FOOTER_LINE_SEPARATOR.split(''.join(footer_text_parts)) if x]
+            for field, pattern in self.footer_fields.items():
+                fields[field] = [
+                    m.group(0).strip() for m in map(pattern.match, footer_lines) if m
+                ]
+
+        return fields
+
+    def _add_links(self, fields, href, a_tag):
+        for field, pattern in self.link_fields.items():
+            m = pattern.search(href)
+            if m:
+                # e.g. telephone number is contained within either the href or text
+                value = (m.group(1) if pattern.groups else href) or a_tag.text
+                if value:
+                    fields[field].add(value)
+
+
+_extractors = {}
+
+def extract_fields(response, item_class):
+    """
+    Extract the fields in the spec for item_class from an HTML response.
+    Extractors are compiled the first time each item class is used.
+    """
+    if item_class not in _extractors:
+        _extractors[item_class] = Extractor(ITEM_SPECS[item_class])
+    return _extractors[item_class].extract(response.selector.root)
@@ -2,54 +2,58 @@
 #
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
+#
+# Items are slotted attrs classes (supported by Scrapy through itemadapter)
+# rather than scrapy.Item, since a scrapy.Item is a dict per item. Every
+# instance of a class has the same fields, and unset fields are None.
 
-from scrapy import Item, Field
+import attr
 
 
 # For custom_sitemap_spider and wayback_sitemap_spider:
-class GenericWebpageItem(Item):
+@attr.s(slots=True)
+class GenericWebpageItem:
     # Fields recorded from every webpage on a website
-    url = Field()
-    level = Field()
-    referer = Field()
-    website = Field()
-    status_code = Field()
-    
-    html = Field()
-    text = Field()
-    
-    phone_numbers = Field()
-    social_links = Field()
-    
-    test = Field()
-    
-    def __init__(self, wayback=False, *a, **kw):
-        if wayback:
-            self.fields['wayback_url'] = Field()
-            self.fields['wayback_dt'] = Field()
-        
-        super().__init__(*a, **kw)
+    url = attr.ib(default=None)
+    level = attr.ib(default=None)
+    referer = attr.ib(default=None)
+    website = attr.ib(default=None)
+    status_code = attr.ib(default=None)
+    truncated_reason = attr.ib(default=None)
+    
+    text = attr.ib(default=None)
+    
+    phone_numbers = attr.ib(default=None)
+    email_addresses = attr.ib(default=None)
+    social_links = attr.ib(default=None)
+    
+    test = attr.ib(default=None)
+    
+    # Only set by wayback_sitemap_spider
+    wayback_url = attr.ib(default=None)
+    wayback_dt = attr.ib(default=None)
 
     
+@attr.s(slots=True)
 class AboutUsItem(GenericWebpageItem):
     # TODO: add specific fields for AboutUs/ContactUs pages
     pass
     
     
+@attr.s(slots=True)
 class HomepageItem(GenericWebpageItem):
     # Fields only recorded from the homepage of each website
-    title = Field()
-    description = Field()
-    author = Field()
-    copyright = Field()
-    
-    cart_software = Field()
-    has_card = Field()
-    payment_systems = Field()
-    
-    ip_address = Field()
-    ssl_certificate = Field()
-    protocol = Field()
-    as_number = Field()
-    reverse_dns_lookup = Field()
-    
\ No newline at end of file
+    title = attr.ib(default=None)
+    description = attr.ib(default=None)
+    author = attr.ib(default=None)
+    copyright = attr.ib(default=None)
+    
+    cart_software = attr.ib(default=None)
+    has_card = attr.ib(default=None)
+    payment_systems = attr.ib(default=None)
+    
+    ip_address = attr.ib(default=None)
+    ssl_certificate = attr.ib(default=None)
+    protocol = attr.ib(default=None)
+    as_number = attr.ib(default=None)
+    reverse_dns_lookup = attr.ib(default=None)
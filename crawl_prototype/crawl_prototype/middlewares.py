@@ -3,11 +3,19 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
-from scrapy import signals
+import codecs
+from collections import Counter
+
+from twisted.python.failure import Failure
+from scrapy import Request, signals
+from scrapy.exceptions import NotConfigured, StopDownload
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+# local:
+from crawl_prototype.checkpoint import CrawlJournal, flush_outputs
+
 
 class CrawlPrototypeSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +109,238 @@ class CrawlPrototypeDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class CheckpointMiddleware:
+    """
+    Records which domains have been completely crawled in a CrawlJournal
+    (at CHECKPOINT_JOURNAL), so that a restarted crawl skips them. Partially
+    crawled domains are crawled again from the start.
+    
+    Every request carries the domain it was started from in
+    meta['cc_domain'], and a domain is complete once none of its requests are
+    pending. A request stops being pending once its callback (or errback)
+    output has been processed, so any follow-up requests have been counted
+    first. Redirected/retried copies of a request share its meta, so they
+    count as the same request.
+    
+    Start requests are pulled lazily (while the downloader has room), so a
+    domain's first request could finish before its other start requests have
+    been pulled. To stop that, each domain holds an extra "start" count until
+    its last start request has been pulled, which needs the start requests of
+    each domain to be consecutive.
+    
+    Requests that fail need an errback for this to see them, so requests
+    without one are given the spider's checkpoint_errback.
+    
+    Before a domain is journaled as done, the checkpoint.flush_outputs signal
+    is sent so that buffered outputs (page text, result store) are written
+    out first.
+    """
+    def __init__(self, journal):
+        self.journal = journal
+        # Only domains done before this run are skipped
+        self.skip_domains = set(journal.done_domains)
+        self.pending = Counter()  # domain -> number of pending requests
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        journal_fpath = crawler.settings.get('CHECKPOINT_JOURNAL')
+        if not journal_fpath:
+            raise NotConfigured
+        s = cls(CrawlJournal(journal_fpath))
+        s.stats = crawler.stats
+        s.signals = crawler.signals
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(s.request_dropped, signal=signals.request_dropped)
+        return s
+
+    def process_start_requests(self, start_requests, spider):
+        starting_domain = None
+        for r in start_requests:
+            domain = r.meta.get('cc_domain')
+            if domain in self.skip_domains:
+                self.stats.inc_value('checkpoint/skipped_requests', spider=spider)
+                continue
+            if domain != starting_domain:
+                # All the start requests of the previous domain have been
+                # pulled
+                self.release(starting_domain)
+                starting_domain = domain
+                if domain is not None:
+                    self.pending[domain] += 1
+            self.track(r, domain, spider)
+            yield r
+        # (Not released if the crawl stops before all the start requests
+        # have been pulled, so the last domain is left partially crawled)
+        self.release(starting_domain)
+
+    def process_spider_output(self, response, result, spider):
+        try:
+            for i in result:
+                if isinstance(i, Request):
+                    self.track(i, response.meta.get('cc_domain'), spider)
+                yield i
+        finally:
+            self.finish(response.request)
+
+    def process_errback_output(self, failure, result, spider):
+        # Output of errbacks for failed downloads doesn't go through the
+        # spider middlewares, so the spider passes it here instead.
+        try:
+            for i in result or []:
+                if isinstance(i, Request):
+                    self.track(i, failure.request.meta.get('cc_domain'), spider)
+                yield i
+        finally:
+            self.finish(failure.request)
+
+    def track(self, request, domain, spider):
+        if domain is None or request.meta.get('checkpoint_tracked'):
+            return
+        request.meta.setdefault('cc_domain', domain)
+        request.meta['checkpoint_tracked'] = True
+        if request.errback is None:
+            request.errback = spider.checkpoint_errback
+        self.pending[request.meta['cc_domain']] += 1
+
+    def finish(self, request):
+        if not request.meta.get('checkpoint_tracked') or request.meta.get('checkpoint_finished'):
+            return
+        request.meta['checkpoint_finished'] = True
+        self.release(request.meta['cc_domain'])
+
+    def release(self, domain):
+        if domain is None:
+            return
+        self.pending[domain] -= 1
+        if self.pending[domain] <= 0:
+            del self.pending[domain]
+            results = self.signals.send_catch_log(signal=flush_outputs, domain=domain)
+            if any(isinstance(response, Failure) for _, response in results):
+                # (the error has already been logged) Left as partially
+                # crawled, so it is crawled again if the crawl is restarted
+                return
+            self.journal.log_done(domain)
+
+    def item_scraped(self, item, response, spider):
+        # Sent after the item has been exported
+        domain = response.meta.get('cc_domain')
+        if domain is not None:
+            self.journal.log_item(domain, ItemAdapter(item).get('url'))
+
+    def request_dropped(self, request, spider):
+        # e.g. duplicate requests removed by the scheduler
+        self.finish(request)
+
+    def spider_opened(self, spider):
+        spider.checkpoint = self
+        spider.logger.info(
+            f"Checkpoint journal: {len(self.journal.done_domains)} domain(s) done, "
+            f"{len(self.journal.partial_domains)} domain(s) partially done"
+        )
+
+    def spider_closed(self, spider):
+        self.journal.close()
+
+
+class DownloadTriageMiddleware:
+    """
+    Aborts downloads early based on the response headers and the first
+    streamed bytes, using the headers_received/bytes_received signals:
+    - responses for callbacks in DOWNLOAD_TRIAGE_HTML_CALLBACKS that are not
+      HTML (e.g. a homepage that redirects to a PDF) are dropped.
+    - responses that go over the byte budget for their callback (see
+      DOWNLOAD_TRIAGE_BUDGETS) are truncated, and the truncated body is still
+      passed to the callback.
+    The reason is stored in response.meta['download_triage'] and counted in
+    the crawl stats. Truncated responses are not cached (by
+    HttpCacheMiddleware), since a cache hit would skip the triage.
+    """
+    HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+    # Content types that don't say what the body is, so the body is sniffed
+    UNKNOWN_CONTENT_TYPES = ('', 'application/octet-stream', 'text/plain')
+    SNIFF_BYTES = 1024
+
+    def __init__(self, stats, budgets, html_callbacks):
+        self.stats = stats
+        self.budgets = budgets
+        self.html_callbacks = set(html_callbacks)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(
+            stats=crawler.stats,
+            budgets=crawler.settings.getdict('DOWNLOAD_TRIAGE_BUDGETS'),
+            html_callbacks=crawler.settings.getlist('DOWNLOAD_TRIAGE_HTML_CALLBACKS'),
+        )
+        crawler.signals.connect(s.headers_received, signal=signals.headers_received)
+        crawler.signals.connect(s.bytes_received, signal=signals.bytes_received)
+        return s
+
+    def headers_received(self, headers, body_length, request, spider):
+        # Redirected/retried copies of a request share its meta, so anything
+        # left from a previous response is reset
+        for key in ['download_triage', 'download_triage_bytes', 'download_triage_sniff']:
+            request.meta.pop(key, None)
+        if get_callback_name(request) not in self.html_callbacks:
+            return
+        content_type = (headers.get('Content-Type') or b'').decode('latin-1')
+        content_type = content_type.split(';')[0].strip().lower()
+        content_encoding = (headers.get('Content-Encoding') or b'identity').decode('latin-1')
+        if content_type in self.UNKNOWN_CONTENT_TYPES:
+            # A compressed body (only decompressed later, by
+            # HttpCompressionMiddleware) can't be sniffed, so is let through
+            if content_encoding.strip().lower() == 'identity':
+                request.meta['download_triage_sniff'] = True
+        elif content_type not in self.HTML_CONTENT_TYPES:
+            self.stop(request, spider, 'non_html', f"non-HTML content type ({content_type})",
+                      fail=True)
+
+    def bytes_received(self, data, request, spider):
+        if request.meta.pop('download_triage_sniff', False):
+            if not looks_like_html(data[:self.SNIFF_BYTES]):
+                self.stop(request, spider, 'non_html', "non-HTML body", fail=True)
+        
+        budget = self.budgets.get(get_callback_name(request))
+        if budget is None:
+            return
+        num_bytes = request.meta.get('download_triage_bytes', 0) + len(data)
+        request.meta['download_triage_bytes'] = num_bytes
+        if num_bytes > budget:
+            self.stop(request, spider, 'over_budget', f"over budget ({budget} bytes)",
+                      fail=False)
+
+    def stop(self, request, spider, kind, reason, fail):
+        request.meta['download_triage'] = reason
+        request.meta['dont_cache'] = True
+        self.stats.inc_value(f'download_triage/{kind}', spider=spider)
+        spider.logger.info(f"Stopped download of {request.url}: {reason}")
+        raise StopDownload(fail=fail)
+
+
+def get_callback_name(request):
+    # Requests without a callback are handled by the spider's parse method
+    return getattr(request.callback, '__name__', 'parse')
+
+
+# (UTF-32 before UTF-16, since the UTF-32 LE BOM starts with the UTF-16 LE BOM)
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF32_LE, 'utf-32-le'), (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'), (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+
+
+def looks_like_html(first_bytes):
+    for bom, encoding in BOM_ENCODINGS:
+        if first_bytes.startswith(bom):
+            # Only ASCII is needed to find the tags
+            first_bytes = (first_bytes[len(bom):].decode(encoding, errors='ignore')
+                           .encode('ascii', errors='ignore'))
+            break
+    first_bytes = first_bytes.lstrip().lower()
+    return (first_bytes.startswith(b'<')
+            and any(tag in first_bytes for tag in [b'<!doctype html', b'<html', b'<head', b'<body']))
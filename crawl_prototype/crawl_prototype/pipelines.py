@@ -2,12 +2,181 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+import os
+import gzip
+import json
+import zlib
+from datetime import datetime
 
-
+from scrapy.exceptions import NotConfigured
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
 
+# local:
+from crawl_prototype.checkpoint import flush_outputs
+from crawl_prototype.result_store import ResultStore, STORED_FIELDS
+
 
 class CrawlPrototypePipeline:
     def process_item(self, item, spider):
         return item
+
+
+class PageTextShardPipeline:
+    """
+    Moves the 'text' field of each item into gzipped JSON-lines shards, so
+    that the page text is kept out of the item feed (e.g. full_sitemap.csv).
+    
+    Each website is assigned to one of PAGE_TEXT_NUM_SHARDS shards (so all the
+    pages of a website end up in the same shard), and a new part file is
+    started when a shard's compressed size exceeds PAGE_TEXT_SHARD_MAX_BYTES.
+    Files are named <PAGE_TEXT_DIR>/shard-<shard>-<part>.jsonl.gz
+    
+    Records are buffered per shard and written as a separate gzip member
+    (a valid multi-member gzip file) once the buffer reaches
+    MEMBER_MAX_BYTES, so if the crawl is killed only the buffered records
+    and the member being written are lost. Buffers are also written before a
+    domain is checkpointed as done (see middlewares.CheckpointMiddleware).
+    """
+    MEMBER_MAX_BYTES = 1024 * 1024  # uncompressed (1MB)
+
+    def __init__(self, text_dir, num_shards, shard_max_bytes):
+        self.text_dir = text_dir
+        self.num_shards = num_shards
+        self.shard_max_bytes = shard_max_bytes
+        self.shard_files = {}  # shard -> open part file
+        self.shard_parts = {}  # shard -> current part number
+        self.shard_buffers = {}  # shard -> encoded lines not yet written
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(
+            text_dir=crawler.settings.get('PAGE_TEXT_DIR'),
+            num_shards=crawler.settings.getint('PAGE_TEXT_NUM_SHARDS'),
+            shard_max_bytes=crawler.settings.getint('PAGE_TEXT_SHARD_MAX_BYTES'),
+        )
+        crawler.signals.connect(s.flush, signal=flush_outputs)
+        return s
+
+    def open_spider(self, spider):
+        os.makedirs(self.text_dir, exist_ok=True)
+
+    def close_spider(self, spider):
+        self.flush()
+        for shard_file in self.shard_files.values():
+            shard_file.close()
+
+    def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        text = adapter.get('text')
+        adapter['text'] = None
+        if text:
+            record = {'website': adapter['website'], 'url': adapter['url'], 'text': text}
+            self._write(record)
+        return item
+
+    def flush(self):
+        """
+        Write the buffered records of every shard to its part file, and sync
+        the part files to disk.
+        """
+        for shard in list(self.shard_buffers):
+            self._write_member(shard)
+        for shard_file in self.shard_files.values():
+            os.fsync(shard_file.fileno())
+
+    def _write(self, record):
+        # crc32 rather than hash() so shards are stable between runs
+        shard = zlib.crc32(record['website'].encode()) % self.num_shards
+        buffer = self.shard_buffers.setdefault(shard, bytearray())
+        buffer += (json.dumps(record) + '\n').encode()
+        if len(buffer) >= self.MEMBER_MAX_BYTES:
+            self._write_member(shard)
+
+    def _write_member(self, shard):
+        buffer = self.shard_buffers.pop(shard)
+        if shard not in self.shard_files:
+            self._open_shard(shard)
+        shard_file = self.shard_files[shard]
+        shard_file.write(gzip.compress(buffer))
+        shard_file.flush()
+        if shard_file.tell() > self.shard_max_bytes:
+            os.fsync(shard_file.fileno())
+            self.shard_files.pop(shard).close()
+            self.shard_parts[shard] += 1
+
+    def _open_shard(self, shard):
+        # Never overwrite part files from previous runs
+        part = self.shard_parts.get(shard, 0)
+        while os.path.exists(self._shard_fpath(shard, part)):
+            part += 1
+        self.shard_parts[shard] = part
+        self.shard_files[shard] = open(self._shard_fpath(shard, part), 'wb')
+
+    def _shard_fpath(self, shard, part):
+        return os.path.join(self.text_dir, f"shard-{shard:03d}-{part:04d}.jsonl.gz")
+
+
+class ResultStorePipeline:
+    """
+    Upserts each item into the per-website rows of a ResultStore (SQLite
+    database at RESULT_STORE_PATH) for this crawl. Disabled if
+    RESULT_STORE_PATH isn't set.
+    
+    Items are buffered and upserted WRITE_EVERY at a time, in one short
+    transaction, since the processes of a sharded crawl share the store and
+    only one can write at a time. The buffer is also written before a
+    domain is checkpointed as done (see middlewares.CheckpointMiddleware).
+    
+    All the processes of a sharded crawl should be given the same
+    RESULT_STORE_CRAWL_TS (default: when the crawl started). If
+    RESULT_STORE_DROP_UNCHANGED is set, websites whose fields haven't changed
+    since their previous snapshot are dropped when the spider closes, so a
+    recrawl only adds rows for changed websites. For a sharded crawl this is
+    done by the launcher instead, once every shard has finished.
+    """
+    WRITE_EVERY = 100  # items
+
+    def __init__(self, store_fpath, crawl_ts, drop_unchanged):
+        self.store_fpath = store_fpath
+        self.crawl_ts = crawl_ts or datetime.now().strftime("%Y%m%d%H%M%S")
+        self.drop_unchanged = drop_unchanged
+        self.website_items = []  # (website, stored fields) not yet written
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        store_fpath = crawler.settings.get('RESULT_STORE_PATH')
+        if not store_fpath:
+            raise NotConfigured
+        s = cls(store_fpath, crawler.settings.get('RESULT_STORE_CRAWL_TS'),
+                crawler.settings.getbool('RESULT_STORE_DROP_UNCHANGED'))
+        crawler.signals.connect(s.flush, signal=flush_outputs)
+        return s
+
+    def open_spider(self, spider):
+        self.store = ResultStore(self.store_fpath, self.crawl_ts)
+
+    def close_spider(self, spider):
+        self.flush()
+        if self.drop_unchanged:
+            num_unchanged = self.store.drop_unchanged()
+            spider.logger.info(f"Result store: {num_unchanged} website(s) unchanged "
+                               f"since their previous snapshot")
+        self.store.close()
+
+    def flush(self):
+        if self.website_items:
+            self.store.upsert_items(self.website_items)
+            self.website_items = []
+
+    def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        website = adapter.get('website')
+        if website is not None:
+            # Copied, since later pipelines/exporters could change the item
+            self.website_items.append(
+                (website, {field: adapter.get(field) for field in STORED_FIELDS})
+            )
+            if len(self.website_items) >= self.WRITE_EVERY:
+                self.flush()
+        return item
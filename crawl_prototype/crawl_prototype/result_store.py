@@ -0,0 +1,174 @@
+# SQLite store of per-website results, kept across crawls (see
+# pipelines.ResultStorePipeline).
+#
+# The websites table has one row (snapshot) per website per crawl in which
+# the website's fields changed, keyed by (website, crawl_ts). last_seen_ts is
+# the most recent crawl that found the same fields. Each field holds a JSON
+# list of the unique values found on any page of the website (like
+# per_website_sitemap.csv).
+#
+# The values of the INDEXED_FIELDS are also stored one per row in the
+# website_values table, which is indexed on (field, value), e.g. websites
+# that used Shopify as of the crawl on 2021-01-01:
+# > SELECT w.website FROM website_values v JOIN websites w USING (website, crawl_ts)
+# > WHERE v.field = 'cart_software' AND v.value = 'Shopify'
+# >   AND w.crawl_ts <= '20210101000000' AND w.last_seen_ts >= '20210101000000'
+#
+# e.g. websites whose cart software changed since the crawl on 2021-01-01:
+# > SELECT cur.website, old.cart_software, cur.cart_software
+# > FROM latest_websites cur JOIN websites old ON old.website = cur.website
+# > WHERE old.crawl_ts <= '20210101000000' AND old.last_seen_ts >= '20210101000000'
+# >   AND cur.cart_software IS NOT old.cart_software
+
+import json
+import sqlite3
+
+
+STORED_FIELDS = [
+    # General
+    'title', 'description', 'author', 'copyright',
+    # eCommerce
+    'cart_software', 'has_card', 'payment_systems',
+    # Marketing
+    'social_links', 'phone_numbers', 'email_addresses',
+    # Hosting
+    'ip_address', 'ssl_certificate', 'protocol', 'as_number',
+    'reverse_dns_lookup', 'status_code',
+]
+INDEXED_FIELDS = [
+    'cart_software', 'has_card', 'payment_systems',
+    'ip_address', 'ssl_certificate', 'protocol', 'as_number',
+    'reverse_dns_lookup', 'status_code',
+]
+
+
+def normalise_value(value):
+    # JSON-able and hashable (e.g. ip_address is an ipaddress object)
+    return value if isinstance(value, (str, int, float, bool)) else str(value)
+
+
+def merge_values(stored_json, value):
+    """
+    Add value (or each element of value, if it is a collection) to the JSON
+    list stored_json. The list is sorted so equal sets of values are stored
+    identically.
+    """
+    values = set(json.loads(stored_json)) if stored_json else set()
+    if isinstance(value, (set, list, tuple)):
+        values.update(normalise_value(v) for v in value if v is not None)
+    elif value is not None:
+        values.add(normalise_value(value))
+    return json.dumps(sorted(values, key=repr)) if values else None
+
+
+class ResultStore:
+    def __init__(self, fpath, crawl_ts):
+        self.crawl_ts = crawl_ts
+        # Several crawler processes (shards) share the same store. SQLite
+        # only allows one writer at a time (WAL mode just lets readers carry
+        # on while it writes), so every write is a short transaction, and
+        # the others wait for it (up to the timeout)
+        self.conn = sqlite3.connect(fpath, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.create_tables()
+
+    def create_tables(self):
+        field_columns = ''.join(f", {field} TEXT" for field in STORED_FIELDS)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS websites ("
+                "website TEXT NOT NULL, crawl_ts TEXT NOT NULL, last_seen_ts TEXT NOT NULL"
+                f"{field_columns}, PRIMARY KEY (website, crawl_ts))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS websites_crawl_ts ON websites (crawl_ts)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS website_values ("
+                "website TEXT NOT NULL, crawl_ts TEXT NOT NULL, field TEXT NOT NULL, value, "
+                "PRIMARY KEY (website, crawl_ts, field, value))"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS website_values_field_value "
+                "ON website_values (field, value)"
+            )
+            self.conn.execute(
+                "CREATE VIEW IF NOT EXISTS latest_websites AS "
+                "SELECT * FROM websites w WHERE crawl_ts = "
+                "(SELECT MAX(crawl_ts) FROM websites WHERE website = w.website)"
+            )
+
+    def upsert_items(self, website_items):
+        """
+        Merge the fields of each (website, item_dict) into the website's row
+        for this crawl, in one write transaction.
+        """
+        with self.conn:
+            # Take the write lock before reading, so the rows can't change
+            # between the SELECT and the INSERT
+            self.conn.execute("BEGIN IMMEDIATE")
+            for website, item_dict in website_items:
+                self._upsert_item(website, item_dict)
+
+    def _upsert_item(self, website, item_dict):
+        row = self.conn.execute(
+            f"SELECT {', '.join(STORED_FIELDS)} FROM websites "
+            "WHERE website = ? AND crawl_ts = ?",
+            (website, self.crawl_ts)
+        ).fetchone()
+        stored_values = row or [None] * len(STORED_FIELDS)
+        merged_values = [
+            merge_values(stored, item_dict.get(field))
+            for field, stored in zip(STORED_FIELDS, stored_values)
+        ]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO websites "
+            f"(website, crawl_ts, last_seen_ts, {', '.join(STORED_FIELDS)}) "
+            f"VALUES (?, ?, ?{', ?' * len(STORED_FIELDS)})",
+            (website, self.crawl_ts, self.crawl_ts, *merged_values)
+        )
+        # (INSERT OR IGNORE since values are only ever added)
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO website_values (website, crawl_ts, field, value) "
+            "VALUES (?, ?, ?, ?)",
+            [(website, self.crawl_ts, field, value)
+             for field, merged in zip(STORED_FIELDS, merged_values)
+             if field in INDEXED_FIELDS and merged is not None
+             for value in json.loads(merged)]
+        )
+
+    def drop_unchanged(self, batch_size=1000):
+        """
+        For every website with a row for this crawl, if the row has the same
+        fields as the website's previous snapshot, delete the new row and
+        update the last_seen_ts of the previous snapshot instead. Should only
+        be run once every process of the crawl has finished, since websites
+        that are still being crawled would lose the fields found so far.
+        Returns the number of unchanged websites.
+        """
+        unchanged = self.conn.execute(
+            "SELECT cur.website, prev.crawl_ts FROM websites cur "
+            "JOIN websites prev ON prev.website = cur.website AND prev.crawl_ts = "
+            "(SELECT MAX(crawl_ts) FROM websites "
+            "WHERE website = cur.website AND crawl_ts < cur.crawl_ts) "
+            "WHERE cur.crawl_ts = ?"
+            + ''.join(f" AND cur.{field} IS prev.{field}" for field in STORED_FIELDS),
+            (self.crawl_ts,)
+        ).fetchall()
+        # Batches, so that other processes aren't kept waiting for the
+        # write lock
+        for i in range(0, len(unchanged), batch_size):
+            batch = unchanged[i:(i + batch_size)]
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.conn.executemany(
+                    "UPDATE websites SET last_seen_ts = ? WHERE website = ? AND crawl_ts = ?",
+                    [(self.crawl_ts, website, previous_ts) for website, previous_ts in batch]
+                )
+                for table in ['websites', 'website_values']:
+                    self.conn.executemany(
+                        f"DELETE FROM {table} WHERE website = ? AND crawl_ts = ?",
+                        [(website, self.crawl_ts) for website, _ in batch]
+                    )
+        return len(unchanged)
+
+    def close(self):
+        self.conn.close()
@@ -40,19 +40,79 @@ CONCURRENT_REQUESTS_PER_IP = 4
 #AUTOTHROTTLE_DEBUG = False
 
 # Middlwares, pipelines etc.
-#SPIDER_MIDDLEWARES = {
+SPIDER_MIDDLEWARES = {
 #    'crawl_prototype.middlewares.CrawlPrototypeSpiderMiddleware': 543,
-#}
-#DOWNLOADER_MIDDLEWARES = {
+    'crawl_prototype.middlewares.CheckpointMiddleware': 10,
+}
+DOWNLOADER_MIDDLEWARES = {
 #    'crawl_prototype.middlewares.CrawlPrototypeDownloaderMiddleware': 543,
-#}
+    'crawl_prototype.middlewares.DownloadTriageMiddleware': 950,
+}
 #EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
 #}
 #TELNETCONSOLE_ENABLED = False  # (enabled by default)
-#ITEM_PIPELINES = {
+ITEM_PIPELINES = {
 #    'crawl_prototype.pipelines.CrawlPrototypePipeline': 300,
-#}
+    'crawl_prototype.pipelines.PageTextShardPipeline': 800,
+    'crawl_prototype.pipelines.ResultStorePipeline': 900,
+}
+
+# Page text (see pipelines.PageTextShardPipeline)
+PAGE_TEXT_DIR = 'spiders_output/page_text'
+PAGE_TEXT_NUM_SHARDS = 16
+PAGE_TEXT_SHARD_MAX_BYTES = 64 * 1024 * 1024  # compressed size (64MB)
+
+# Download triage (see middlewares.DownloadTriageMiddleware)
+# Callbacks that should only be given HTML responses:
+DOWNLOAD_TRIAGE_HTML_CALLBACKS = ['parse_homepage', 'parse_about_us']
+# Maximum body size (bytes) for each callback, larger bodies are truncated:
+DOWNLOAD_TRIAGE_BUDGETS = {
+    'parse_homepage': 2 * 1024 * 1024,  # 2MB
+    'parse_about_us': 1024 * 1024,  # 1MB
+    '_parse_sitemap': 20 * 1024 * 1024,  # 20MB
+}
+
+# Per-website result store (see pipelines.ResultStorePipeline). Disabled
+# unless a filepath is given, e.g. -s RESULT_STORE_PATH=<filepath>
+RESULT_STORE_PATH = None
+RESULT_STORE_CRAWL_TS = None  # (default: when the crawl started)
+# Drop the rows of websites that haven't changed when the spider closes
+# (custom_sitemap_launcher.py turns this off and does it once all its shards
+# have finished)
+RESULT_STORE_DROP_UNCHANGED = True
+
+# Checkpointing (see middlewares.CheckpointMiddleware). Disabled unless a
+# journal filepath is given, e.g. -s CHECKPOINT_JOURNAL=<filepath>
+CHECKPOINT_JOURNAL = None
+
+# Output feed
+# Fixed columns so that CSV output from a resumed crawl can be appended to
+# the output from the previous run. ('text' is written separately by
+# pipelines.PageTextShardPipeline)
+FEED_EXPORT_FIELDS = [
+    'url', 'level', 'referer', 'website', 'status_code', 'truncated_reason',
+    'phone_numbers', 'email_addresses', 'social_links', 'test',
+    'title', 'description', 'author', 'copyright',
+    'cart_software', 'has_card', 'payment_systems',
+    'ip_address', 'ssl_certificate', 'protocol', 'as_number', 'reverse_dns_lookup',
+]
+FEED_STORAGES = {
+    '': 'crawl_prototype.checkpoint.UnbufferedFileFeedStorage',
+    'file': 'crawl_prototype.checkpoint.UnbufferedFileFeedStorage',
+}
+FEED_EXPORTERS = {
+    'csv': 'crawl_prototype.exporters.AttrsCsvItemExporter',
+}
+
+# Request dupefilter (see dupefilters.BloomDupeFilter)
+DUPEFILTER_CLASS = 'crawl_prototype.dupefilters.BloomDupeFilter'
+# Filter files, which can be shared by the processes of a single sharded
+# crawl. Don't reuse them for a resumed crawl (unless using JOBDIR), since
+# requests that were still pending when it stopped would be filtered out.
+DUPEFILTER_BLOOM_PATH = None  # (default: JOBDIR/requests.bloom or temp files)
+DUPEFILTER_BLOOM_CAPACITY = 1000000  # capacity of the first filter (doubles)
+DUPEFILTER_BLOOM_ERROR_RATE = 0.001  # max false positive rate
 
 # HTTP caching (disabled by default)
 HTTPCACHE_ENABLED = True
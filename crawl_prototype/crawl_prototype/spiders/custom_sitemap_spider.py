@@ -10,12 +10,9 @@
 # $ ~/.local/bin/pyasn_util_download.py --latest
 # $ ~/.local/bin/pyasn_util_convert.py --single <downloaded_RIB_filename> <ipasn_db_filename>
 
-import re
 import logging
 import socket
 import requests
-import unicodedata
-# from bs4 import BeautifulSoup
 from urllib.parse import urlsplit
 
 from scrapy import Request
@@ -25,7 +22,7 @@ from twisted.internet.error import ConnectionRefusedError
 
 # local:
 import ecom_utils
-from crawl_prototype import items, settings
+from crawl_prototype import extractors, items, settings
 
             
 def get_url_level(url):
@@ -75,10 +72,7 @@ class CustomSitemapSpider(SitemapSpider):
                 raise ValueError(f"cc_end should be <= {num_lines} (num_lines+1)")
         # Subtract one from cc_start/cc_end so that they correspond to line 
         # numbers.
-        self.homepage_urls = [
-            f"https://{domain}" 
-            for domain in cc_domains_all[(cc_start_int - 1):(cc_end_int - 1)]
-        ]
+        self.cc_domains = cc_domains_all[(cc_start_int - 1):(cc_end_int - 1)]
         
         SITEMAP_SUFFIXES = [
             "/robots.txt",
@@ -92,18 +86,33 @@ class CustomSitemapSpider(SitemapSpider):
         super().__init__(*a, **kw)
 
     def start_requests(self):
-        for homepage in self.homepage_urls:
-            yield Request(homepage, callback=self.parse_homepage)
+        # cc_domain is used by middlewares.CheckpointMiddleware to track which
+        # domains have been completely crawled.
+        for domain in self.cc_domains:
+            homepage = f"https://{domain}"
+            yield Request(homepage, callback=self.parse_homepage, 
+                          meta={'cc_domain': domain})
             
             sitemap_to_try = self.next_sitemap['START']
             yield Request(
                 homepage + sitemap_to_try, 
                 callback=self._parse_sitemap, 
                 errback=self.sitemap_errback, 
-                meta={'homepage': homepage, 'sitemap': sitemap_to_try}
+                meta={'cc_domain': domain, 'homepage': homepage, 'sitemap': sitemap_to_try}
             )
+    
+    def checkpoint_errback(self, failure, result=None):
+        # Default errback (when CheckpointMiddleware is enabled), so that
+        # failed requests are counted as finished.
+        checkpoint = getattr(self, 'checkpoint', None)
+        if checkpoint is None:
+            return result
+        return checkpoint.process_errback_output(failure, result, self)
            
     def sitemap_errback(self, failure):
+        return self.checkpoint_errback(failure, self._next_sitemap_requests(failure))
+    
+    def _next_sitemap_requests(self, failure):
         # If the website doesn't have the given sitemap suffix (ie returns 404
         # status code), then the next suffix is tried (if there is a next one).
         if failure.check(HttpError) and failure.value.response.status == 404:
@@ -127,49 +136,38 @@ class CustomSitemapSpider(SitemapSpider):
         """
         hp_item = preexisting_item or items.HomepageItem()
         
-        # "Content"
-        hp_item['title'] = response.xpath('//title/text()').get()
-        hp_item['author'] = response.xpath("//meta[@name='author']/@content").get()
-        hp_item['description'] = response.xpath("//meta[@name='description']/@content").get()
-        
-        footer = ''.join(response.xpath("//footer//text()").getall())
-        footer_parts = [x for x in re.split(r'\n|\t|\r', footer) if x]
-        # \xa9 is unicode for the copyright symbol
-        footer_copyright_parts = [
-            re.match(r'^.*(\xa9|copyright).*$', text, flags=re.I) 
-            for text in footer_parts
-        ]
-        hp_item['as_number'] = [
-            t.group(0).strip() for t in footer_copyright_parts if t
-        ]
+        # "Content" fields (title, author, etc) are extracted from the HTML in
+        # parse_generic_webpage, see extractors.HOMEPAGE_SPEC
         
         # (Try to) Detect ecommerce software
-        response_html = response.body.decode()
-        hp_item['cart_software'] = ecom_utils.detect_cart_softwares(response_html)
-        hp_item['has_card'] = ecom_utils.detect_if_has_card(response_html)
-        hp_item['payment_systems'] = ecom_utils.detect_payment_systems(response_html)
+        # (response.text rather than body.decode(), since a truncated body
+        # can end part way through a multi-byte character)
+        response_html = response.text
+        hp_item.cart_software = ecom_utils.detect_cart_softwares(response_html)
+        hp_item.has_card = ecom_utils.detect_if_has_card(response_html)
+        hp_item.payment_systems = ecom_utils.detect_payment_systems(response_html)
         
         # Add more hosting information? e.g. AS number, AS company
-        hp_item['ip_address'] = response.ip_address
-        hp_item['ssl_certificate'] = (response.certificate is not None
-                                      if not settings.HTTPCACHE_ENABLED 
-                                      else "*cached copy*")
-        hp_item['protocol'] = (response.protocol 
-                               if not settings.HTTPCACHE_ENABLED 
-                               else "*cached copy*")
+        hp_item.ip_address = response.ip_address
+        hp_item.ssl_certificate = (response.certificate is not None
+                                   if not settings.HTTPCACHE_ENABLED 
+                                   else "*cached copy*")
+        hp_item.protocol = (response.protocol 
+                            if not settings.HTTPCACHE_ENABLED 
+                            else "*cached copy*")
         
-#         hp_item['test'] = requests.get(f"http://whois.arin.net/rest/ip/{response.ip_address}").content
-#         hp_item['test'] = (response.ip_address.reverse_pointer 
-#                            if not settings.HTTPCACHE_ENABLED 
-#                            else "*cached copy*")
+#         hp_item.test = requests.get(f"http://whois.arin.net/rest/ip/{response.ip_address}").content
+#         hp_item.test = (response.ip_address.reverse_pointer 
+#                         if not settings.HTTPCACHE_ENABLED 
+#                         else "*cached copy*")
         try:
-            hp_item['reverse_dns_lookup'] = (
+            hp_item.reverse_dns_lookup = (
                 socket.gethostbyaddr(str(response.ip_address))[0] 
                 if not settings.HTTPCACHE_ENABLED else "*cached copy*"
             )
         except socket.herror as e:
             if e.strerror == "Unknown host":
-                hp_item['reverse_dns_lookup'] = "Unknown"
+                hp_item.reverse_dns_lookup = "Unknown"
             else:
                 raise e
         
@@ -190,30 +188,19 @@ class CustomSitemapSpider(SitemapSpider):
         """
         gwp_item = preexisting_item or items.GenericWebpageItem()
         
-        gwp_item['url'] = response.url
-        gwp_item['level'] = get_url_level(response.url)
+        gwp_item.url = response.url
+        gwp_item.level = get_url_level(response.url)
         referer = response.request.headers.get('referer', None)
-        gwp_item['referer'] = referer.decode() if referer else None
-        gwp_item['website'] = get_domain(response.url)
-        gwp_item['status_code'] = response.status
+        gwp_item.referer = referer.decode() if referer else None
+        gwp_item.website = get_domain(response.url)
+        gwp_item.status_code = response.status
+        # Set by middlewares.DownloadTriageMiddleware
+        gwp_item.truncated_reason = response.meta.get('download_triage')
         
-#         gwp_item['html'] = str(response.body)
-#         page_text = BeautifulSoup(response.body, 'html.parser').get_text()
-#         clean_text = '\n'.join(x for x in page_text.split('\n') if x)  # remove redundant newlines
-#         cleaner_text = unicodedata.normalize('NFKD', clean_text)  # remove decoding mistakes
-#         gwp_item['text'] = cleaner_text
-    
-        gwp_item['phone_numbers'] = set()
-        gwp_item['social_links'] = set()
-        for a_tag in response.xpath('//a[@href]'):
-            href = a_tag.xpath('@href').get()
-            if href.startswith('tel:'):
-                # telephone number is contained within either the href or text
-                if len(href) > 4:
-                    gwp_item['phone_numbers'].add(href[4:])
-                else:
-                    gwp_item['phone_numbers'].add(a_tag.xpath('text()').get()) 
-            if any(social_name in href for social_name in ['facebook','instagram','twitter','youtube','linkedin']):
-                gwp_item['social_links'].add(href)
+        # Fields extracted from the HTML depend on the class of the item (see
+        # extractors.ITEM_SPECS). 'text' is written to the page text shards
+        # (and cleared from the item) by pipelines.PageTextShardPipeline.
+        for field, value in extractors.extract_fields(response, type(gwp_item)).items():
+            setattr(gwp_item, field, value)
         
         yield gwp_item
@@ -11,7 +11,7 @@ from scrapy import Request
 from scrapy_wayback_machine import UnhandledIgnoreRequest
 
 # local:
-from crawl_prototype import items
+from crawl_prototype import items, settings
 from crawl_prototype.spiders.custom_sitemap_spider import CustomSitemapSpider
 
 
@@ -20,24 +20,26 @@ class WaybackSitemapSpider(CustomSitemapSpider):
     custom_settings = {
         'DOWNLOADER_MIDDLEWARES': {
             'scrapy_wayback_machine.WaybackMachineMiddleware': 543,
+            'crawl_prototype.middlewares.DownloadTriageMiddleware': 950,
         },
-        'WAYBACK_MACHINE_TIME_RANGE': ('20200101120000', '20200301120000')
+        'WAYBACK_MACHINE_TIME_RANGE': ('20200101120000', '20200301120000'),
+        'FEED_EXPORT_FIELDS': settings.FEED_EXPORT_FIELDS + ['wayback_url', 'wayback_dt'],
     }
 
     def get_wayback_meta(self, response, item):
-        item['wayback_url'] = response.meta['wayback_machine_url']
+        item.wayback_url = response.meta['wayback_machine_url']
         dt_str = re.search("^https://web.archive.org/web/(\d{14})id_/",
-                           item['wayback_url']).groups(1)[0]
-        item['wayback_dt'] = int(dt_str)
+                           item.wayback_url).groups(1)[0]
+        item.wayback_dt = int(dt_str)
         return item
         
     def parse_homepage(self, response):
-        enhanced_item = items.HomepageItem(wayback=True)
+        enhanced_item = items.HomepageItem()
         enhanced_item = self.get_wayback_meta(response, enhanced_item)
         return super().parse_homepage(response, enhanced_item)
         
     def parse_about_us(self, response):
-        enhanced_item = items.AboutUsItem(wayback=True)
+        enhanced_item = items.AboutUsItem()
         enhanced_item = self.get_wayback_meta(response, enhanced_item)
         return super().parse_homepage(response, enhanced_item)
     
@@ -0,0 +1,200 @@
+# Runs the custom_sitemap spider as several crawler processes (one per shard
+# of the CC_START/CC_END range) so that more than one core is used, since the
+# parsing in each process is CPU-bound on the Twisted reactor thread.
+#
+# Each shard has its own folder in OUTPUT_FOLDER (output, log, stderr,
+# checkpoint journal, page text) and its own HTTP cache directory. A shard process that
+# fails is restarted, and resumes from its checkpoint journal. Once all
+# shards have finished, their outputs are merged into
+# OUTPUT_FOLDER/per_website_sitemap.csv. Results are also upserted into the
+# --result_store database (if given) as the shards crawl, and the rows of
+# websites that haven't changed since the previous crawl are dropped once
+# every shard has finished.
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+from datetime import datetime
+
+# local:
+import custom_sitemap_postproc
+from crawl_prototype.result_store import ResultStore
+
+
+def split_range(cc_start, cc_end, num_shards):
+    """
+    Split [cc_start, cc_end) into (at most) num_shards contiguous ranges of
+    near-equal size.
+    """
+    num_lines = cc_end - cc_start
+    num_shards = max(1, min(num_shards, num_lines))
+    shard_size, remainder = divmod(num_lines, num_shards)
+    shard_ranges = []
+    shard_start = cc_start
+    for i in range(num_shards):
+        shard_end = shard_start + shard_size + (1 if i < remainder else 0)
+        shard_ranges.append((shard_start, shard_end))
+        shard_start = shard_end
+    return shard_ranges
+
+
+def get_crawl_ts(output_folder):
+    """
+    Timestamp of the crawl for the result store, saved in the output folder so
+    that a resumed crawl keeps the same timestamp.
+    """
+    crawl_ts_fpath = os.path.join(output_folder, "crawl_ts.txt")
+    if os.path.exists(crawl_ts_fpath):
+        with open(crawl_ts_fpath) as f:
+            return f.read().strip()
+    crawl_ts = datetime.now().strftime("%Y%m%d%H%M%S")
+    os.makedirs(output_folder, exist_ok=True)
+    with open(crawl_ts_fpath, 'w') as f:
+        f.write(crawl_ts)
+    return crawl_ts
+
+
+class Shard:
+    def __init__(self, shard_num, cc_start, cc_end, output_folder, extra_settings=None):
+        self.shard_num = shard_num
+        self.cc_start = cc_start
+        self.cc_end = cc_end
+        self.folder = os.path.join(output_folder, f"shard-{shard_num:03d}")
+        self.extra_settings = extra_settings or {}
+        self.process = None
+        self.num_restarts = 0
+
+    @property
+    def full_sitemap_fpath(self):
+        return os.path.join(self.folder, "full_sitemap.csv")
+
+    @property
+    def stderr_fpath(self):
+        return os.path.join(self.folder, "stderr.txt")
+
+    def start(self):
+        os.makedirs(self.folder, exist_ok=True)
+        command = [
+            'scrapy', 'crawl', 'custom_sitemap',
+            '-o', self.full_sitemap_fpath,
+            '--logfile', os.path.join(self.folder, "log.txt"),
+            '-s', f"PAGE_TEXT_DIR={os.path.join(self.folder, 'page_text')}",
+            '-s', f"CHECKPOINT_JOURNAL={os.path.join(self.folder, 'checkpoint_journal.jsonl')}",
+            # (relative to the project's .scrapy/ folder)
+            '-s', f"HTTPCACHE_DIR=httpcache/shard-{self.shard_num:03d}",
+            '-a', f"cc_start={self.cc_start}", '-a', f"cc_end={self.cc_end}",
+        ]
+        for name, value in self.extra_settings.items():
+            command += ['-s', f"{name}={value}"]
+        # Anything printed before logging to log.txt starts (e.g. tracebacks
+        # for import/settings errors) is kept in stderr.txt
+        with open(self.stderr_fpath, 'ab') as stderr_file:
+            self.process = subprocess.Popen(command, stdout=stderr_file,
+                                            stderr=subprocess.STDOUT)
+
+    def __str__(self):
+        return f"Shard {self.shard_num} (cc_start={self.cc_start}, cc_end={self.cc_end})"
+
+
+def run_shards(shards, max_restarts, poll_secs):
+    """
+    Start every shard and wait until they have all finished, restarting shards
+    whose process exits with an error (up to max_restarts times each).
+    Returns the shards that did not finish successfully.
+    """
+    for shard in shards:
+        shard.start()
+        print(f"Started {shard}")
+
+    running, failed = list(shards), []
+    try:
+        while running:
+            time.sleep(poll_secs)
+            for shard in list(running):
+                return_code = shard.process.poll()
+                if return_code is None:
+                    continue
+                elif return_code == 0:
+                    running.remove(shard)
+                    print(f"Finished {shard} ({len(running)} still running)")
+                elif shard.num_restarts < max_restarts:
+                    shard.num_restarts += 1
+                    print(f"Restarting {shard} after exit code {return_code} "
+                          f"(restart {shard.num_restarts}/{max_restarts})")
+                    shard.start()
+                else:
+                    running.remove(shard)
+                    failed.append(shard)
+                    print(f"FAILED {shard} after {max_restarts} restarts, "
+                          f"see {os.path.join(shard.folder, 'log.txt')} "
+                          f"and {shard.stderr_fpath}")
+    except KeyboardInterrupt:
+        # Progress is kept in each shard's checkpoint journal, so rerunning
+        # resumes the crawl
+        for shard in running:
+            shard.process.terminate()
+        for shard in running:
+            shard.process.wait()
+        raise
+
+    return failed
+
+
+def merge_shards(shards, output_fpath):
+    """
+    Postprocess each shard and append it to output_fpath. Shards cover
+    contiguous ranges in order, so only one shard is in memory at a time.
+    """
+    for i, shard in enumerate(shards):
+        per_website_sitemap = custom_sitemap_postproc.postprocess(
+            shard.full_sitemap_fpath, shard.cc_start, shard.cc_end
+        )
+        per_website_sitemap.to_csv(output_fpath, mode='w' if i == 0 else 'a',
+                                   header=(i == 0))
+        print(f"Merged {shard}")
+
+
+if __name__ == "__main__":
+    # Translate command line arguments into Python variables
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cc_start", type=int)
+    parser.add_argument("--cc_end", type=int)
+    parser.add_argument("--output_folder", type=str)
+    parser.add_argument("--num_shards", type=int, default=os.cpu_count())
+    parser.add_argument("--max_restarts", type=int, default=3)
+    parser.add_argument("--poll_secs", type=float, default=5)
+    # SQLite database of per-website results, kept across crawls (optional)
+    parser.add_argument("--result_store", type=str, default=None)
+    args = parser.parse_args()
+
+    extra_settings = {}
+    if args.result_store:
+        extra_settings['RESULT_STORE_PATH'] = os.path.abspath(args.result_store)
+        extra_settings['RESULT_STORE_CRAWL_TS'] = get_crawl_ts(args.output_folder)
+        # Done below, since a shard can't tell when the others have finished
+        extra_settings['RESULT_STORE_DROP_UNCHANGED'] = False
+    shards = [
+        Shard(i, shard_start, shard_end, args.output_folder, extra_settings)
+        for i, (shard_start, shard_end)
+        in enumerate(split_range(args.cc_start, args.cc_end, args.num_shards))
+    ]
+    print(f"Crawling lines {args.cc_start}-{args.cc_end} with {len(shards)} shard(s)")
+    failed = run_shards(shards, args.max_restarts, args.poll_secs)
+
+    print("\n\nStarting post-processing")
+    merge_shards(shards, os.path.join(args.output_folder, "per_website_sitemap.csv"))
+    print("Finished post-processing")
+    if args.result_store:
+        # Covers every website in this crawl, including those crawled by
+        # shard processes that were killed and restarted
+        store = ResultStore(extra_settings['RESULT_STORE_PATH'],
+                            extra_settings['RESULT_STORE_CRAWL_TS'])
+        num_unchanged = store.drop_unchanged()
+        store.close()
+        print(f"Result store: {num_unchanged} website(s) unchanged since their previous snapshot")
+    if failed:
+        # Websites from failed shards are included, but may be incomplete
+        print(f"{len(failed)} shard(s) failed: {', '.join(str(s) for s in failed)}")
+        sys.exit(1)
@@ -0,0 +1,85 @@
+# Compares the memory used by (and time taken to serialise) 100k items with
+# the slotted attrs items in crawl_prototype/items.py, against the same
+# fields as a dict-backed scrapy.Item (which the items used to be).
+# Serialising is timed for the CSV feed export (as in a crawl, see
+# exporters.AttrsCsvItemExporter) and for ItemAdapter.asdict().
+#
+# $ python3 item_memory_benchmark.py [--num_items 100000]
+
+import io
+import time
+import argparse
+import tracemalloc
+
+from itemadapter import ItemAdapter
+from scrapy import Item, Field
+
+# local:
+from crawl_prototype import items, settings
+from crawl_prototype.exporters import AttrsCsvItemExporter
+
+
+# Same fields as items.HomepageItem (plus the html field it used to have)
+ScrapyHomepageItem = type('ScrapyHomepageItem', (Item,), {
+    field: Field()
+    for field in list(ItemAdapter(items.HomepageItem()).field_names()) + ['html']
+})
+
+
+def make_item(item_class, i):
+    item = item_class()
+    values = {
+        'url': f"https://www.example{i}.co.nz/",
+        'level': 1,
+        'referer': None,
+        'website': f"example{i}.co.nz",
+        'status_code': 200,
+        'phone_numbers': {'+64 9 123 4567'},
+        'email_addresses': set(),
+        'social_links': {f"https://www.facebook.com/example{i}"},
+        'title': f"Example {i}",
+        'cart_software': ['Shopify'],
+        'has_card': True,
+        'payment_systems': ['visa', 'mastercard'],
+        'ip_address': '203.0.113.1',
+    }
+    adapter = ItemAdapter(item)
+    for field, value in values.items():
+        adapter[field] = value
+    return item
+
+
+def benchmark(item_class, num_items):
+    tracemalloc.start()
+    item_list = [make_item(item_class, i) for i in range(num_items)]
+    memory_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    exporter = AttrsCsvItemExporter(io.BytesIO(), fields_to_export=settings.FEED_EXPORT_FIELDS)
+    exporter.start_exporting()
+    tstart = time.perf_counter()
+    for item in item_list:
+        exporter.export_item(item)
+    export_secs = time.perf_counter() - tstart
+    exporter.finish_exporting()
+
+    tstart = time.perf_counter()
+    for item in item_list:
+        ItemAdapter(item).asdict()
+    asdict_secs = time.perf_counter() - tstart
+
+    return memory_bytes, export_secs, asdict_secs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_items", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{args.num_items} items:")
+    for name, item_class in [("scrapy.Item", ScrapyHomepageItem),
+                             ("attrs (slots)", items.HomepageItem)]:
+        memory_bytes, export_secs, asdict_secs = benchmark(item_class, args.num_items)
+        print(f"  {name:<15} {memory_bytes / 1024**2:8.1f} MB "
+              f"({memory_bytes / args.num_items:6.0f} bytes/item), "
+              f"CSV export: {export_secs:.2f}s, asdict: {asdict_secs:.2f}s")
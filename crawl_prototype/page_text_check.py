@@ -0,0 +1,72 @@
+# Checks that the page text from extractors.Extractor (one tree walk) is the
+# same as from the //body//text() XPath query it replaced, for some example
+# HTML and for any HTML files given. Also checks that the copyright line is
+# found in the footer of the examples that have one.
+#
+# $ python3 page_text_check.py [<html file> ...]
+
+import sys
+import argparse
+import unicodedata
+
+from lxml import etree
+from scrapy import Selector
+
+# local:
+from crawl_prototype import extractors
+
+
+# The XPath query that parse_generic_webpage used for the page text
+PAGE_TEXT_XPATH = etree.XPath(
+    '//body//text()[not(ancestor::script or ancestor::style or ancestor::noscript'
+    ' or ancestor::template or ancestor::nav or ancestor::header'
+    ' or ancestor::footer or ancestor::form)]',
+    smart_strings=False
+)
+
+EXAMPLES = {
+    'comment tail': "<html><body><p>a</p><!-- c -->after<p>b</p></body></html>",
+    'wordpress markers': (
+        "<html><body><div class='entry'><p>Welcome</p></div><!-- .entry -->"
+        "Opening hours<footer><!-- .site-info -->\xa9 2021 Example Ltd</footer>"
+        "</body></html>"
+    ),
+    'processing instruction': "<html><body><p>a</p><?php echo 1 ?>after</body></html>",
+    'boilerplate': (
+        "<html><head><title>t</title></head><body><nav>menu<!-- x -->skip</nav>"
+        "<p>keep<script>var x;</script>tail</p><form><input>f</form>end</body></html>"
+    ),
+}
+COPYRIGHT_EXAMPLES = {'wordpress markers': ["\xa9 2021 Example Ltd"]}
+
+
+def xpath_page_text(root):
+    text_parts = (x.strip() for x in PAGE_TEXT_XPATH(root))
+    clean_text = '\n'.join(x for x in text_parts if x)
+    return unicodedata.normalize('NFKD', clean_text)
+
+
+def check(name, html):
+    fields = extractors.Extractor(extractors.HOMEPAGE_SPEC).extract(Selector(text=html).root)
+    expected = xpath_page_text(Selector(text=html).root)
+    ok = fields['text'] == expected
+    if not ok:
+        print(f"FAILED {name}: page text\n  expected: {expected!r}\n  got:      {fields['text']!r}")
+    if name in COPYRIGHT_EXAMPLES and fields['copyright'] != COPYRIGHT_EXAMPLES[name]:
+        print(f"FAILED {name}: copyright {fields['copyright']!r}")
+        ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("html_fpaths", nargs='*')
+    args = parser.parse_args()
+
+    pages = dict(EXAMPLES)
+    for fpath in args.html_fpaths:
+        with open(fpath, encoding='utf-8', errors='replace') as f:
+            pages[fpath] = f.read()
+    num_failed = sum(not check(name, html) for name, html in pages.items())
+    print(f"{len(pages) - num_failed}/{len(pages)} page(s) OK")
+    sys.exit(1 if num_failed else 0)
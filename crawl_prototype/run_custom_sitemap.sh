@@ -7,34 +7,32 @@
 CC_START=5000
 CC_END=5020
 OUTPUT_FOLDER="spiders_output/custom_sitemap"
+# Number of crawler processes (defaults to number of cores if empty)
+NUM_SHARDS=
+# SQLite database of per-website results, kept across crawls, so that
+# only websites that have changed since the last crawl get new rows
+# (see crawl_prototype/result_store.py)
+RESULT_STORE="spiders_output/results.sqlite"
 if [ ! -d $OUTPUT_FOLDER ] 
 then
-  mkdir $OUTPUT_FOLDER
+  mkdir -p $OUTPUT_FOLDER
 fi
 
-# scrapy outputs a LARGE AMOUNT of logging information; easier to
-# navigate with a freshly-clean console.
-clear
+# The CC_START-CC_END range is split into NUM_SHARDS shards, each of
+# which is crawled by a separate scrapy process (see
+# custom_sitemap_launcher.py). Each shard's scrapy log is in
+# $OUTPUT_FOLDER/shard-<num>/log.txt (and anything printed before the
+# log starts, e.g. import errors, is in $OUTPUT_FOLDER/shard-<num>/stderr.txt)
+#
+# If the crawl is stopped part way through, running this script again
+# resumes it: websites recorded as finished in each shard's
+# checkpoint_journal.jsonl are skipped and new items are appended to
+# the shard's full_sitemap.csv. Delete the OUTPUT_FOLDER to start from
+# scratch (or when changing NUM_SHARDS).
 
-# ---Three options for logging---------------------------------------
-# 1. Just console:
-# scrapy crawl custom_sitemap \
-#   -O $OUTPUT_FOLDER/full_sitemap.csv \
-#   -a cc_start=$CC_START -a cc_end=$CC_END
-# -------------------------------------------------------------------
-# 2. Both console and txt file:
-exec &> >(tee $OUTPUT_FOLDER/log.txt)
-scrapy crawl custom_sitemap \
-  -O $OUTPUT_FOLDER/full_sitemap.csv \
-  -a cc_start=$CC_START -a cc_end=$CC_END
-# -------------------------------------------------------------------
-# 3. Just txt file:
-# scrapy crawl custom_sitemap \
-#   -O $OUTPUT_FOLDER/full_sitemap.csv \
-#   --logfile $OUTPUT_FOLDER/log.txt \
-#   -a cc_start=$CC_START -a cc_end=$CC_END
-# -------------------------------------------------------------------
-
-# Post-processing
-python3 custom_sitemap_postproc.py \
-  --cc_start $CC_START --cc_end $CC_END --output_folder $OUTPUT_FOLDER
+# Launcher and post-processing output to both console and txt file:
+exec &> >(tee -a $OUTPUT_FOLDER/log.txt)
+python3 custom_sitemap_launcher.py \
+  --cc_start $CC_START --cc_end $CC_END --output_folder $OUTPUT_FOLDER \
+  --result_store $RESULT_STORE \
+  ${NUM_SHARDS:+--num_shards $NUM_SHARDS}
@@ -4,16 +4,20 @@
 # $ websites['Words'] = websites['Text'].map(gensim.utils.simple_preprocess)
 
 import os, subprocess
+import gzip
 import re
 import csv, json, pickle
 import math
 import boto3, botocore
 from urllib import parse
-from collections import Counter
+from array import array
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import matplotlib.pyplot as plt
 from more_itertools import chunked
 from wordcloud import WordCloud
@@ -21,8 +25,10 @@ from wordcloud import WordCloud
 
 import nltk
 import gensim
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.feature_extraction.text import TfidfVectorizer, TfidfTransformer
+from sklearn.cluster import MiniBatchKMeans
+
+KM_BATCH_SIZE = 4096
 
     
 # S3 Functions
@@ -63,6 +69,19 @@ def read_csv_from_s3(bucket, key, header=True):
     return df
 
 
+def iter_csv_chunks_from_s3(bucket, key, chunk_size):
+    """
+    Yield DataFrames of (at most) chunk_size rows from a CSV on S3. The file is
+    parsed as it is streamed, so unlike read_csv_from_s3() the whole file is
+    never held in memory.
+    """
+    s3 = sess.client('s3')
+    resp = s3.get_object(Bucket=bucket, Key=key)
+    # All columns as strings (like read_csv_from_s3), with empty fields as ''
+    yield from pd.read_csv(resp['Body'], chunksize=chunk_size, dtype=str,
+                           keep_default_na=False)
+
+
 def write_to_csv_s3(csv_list, bucket, key):
     """
     csv_list: list[list[?]], where each inner list will correspond to a row in the
@@ -122,38 +141,275 @@ def get_word_counts(text):
 #     return avg_word_freqs
 
 
-def load_websites_df(batch, bucket):
+def iter_website_text_chunks(batch, bucket, chunk_size=10000):
+    """
+    Yield (netlocs, texts) chunks of webpages, so that only one chunk of text
+    is held in memory at a time. Uses the aggregated websites CSV if it is
+    available on S3, otherwise each processed ccmain bunch is read in turn.
+    
+    A website can be split over multiple chunks (its pages are merged when the
+    word counts are accumulated).
+    """
     s3 = sess.client('s3')
     
     site_agg_key = f"commoncrawl/website_aggregated/{batch}_NZ-websites.csv"
     if is_s3_key_valid(bucket, site_agg_key):
-        websites = read_csv_from_s3(bucket, site_agg_key)
+        for websites in iter_csv_chunks_from_s3(bucket, site_agg_key, chunk_size):
+            yield list(websites['Netloc']), list(websites['Text'])
         print("Loaded websites from S3")
     else:
         output_keys = [
             x['Key'] for x in
             s3.list_objects_v2(Bucket="statsnz-covid-xmiles", Prefix=f"commoncrawl/processed_ccmain_bunches/{batch}/")['Contents']
         ]
+        for key in output_keys:
+            for bunch in iter_csv_chunks_from_s3("statsnz-covid-xmiles", key, chunk_size):
+                yield [parse.urlsplit(url).netloc for url in bunch['URL']], list(bunch['Text'])
+            print(f"Collected webpages from {key}")
+
+
+def iter_page_text_shards(text_dir, chunk_size=10000):
+    """
+    Yield (netlocs, texts) chunks from the gzipped JSON-lines page text shards
+    written by crawl_prototype's PageTextShardPipeline, so a crawl's text can
+    be passed straight to get_sparse_word_counts(). Shards in subfolders are
+    included (e.g. text_dir can be the output folder of a sharded crawl).
+    """
+    for records in chunked(iter_page_text_records(text_dir), chunk_size):
+        yield [r['website'] for r in records], [r['text'] for r in records]
+
+
+def iter_page_text_records(text_dir):
+    """
+    Yield the records in the page text shards in text_dir, skipping pages
+    (website, url) that have already been seen, since a resumed crawl
+    recrawls partially-crawled websites. All the pages of a website are in
+    the same shard (shard-<shard>-<part>.jsonl.gz files in one folder), so
+    only one shard's pages are kept in memory at a time.
+    """
+    shard_fpaths = defaultdict(list)  # (folder, shard) -> part filepaths
+    for dirpath, _, fnames in os.walk(text_dir):
+        for fname in fnames:
+            if fname.endswith(".jsonl.gz"):
+                shard = fname.split('-')[1]
+                shard_fpaths[(dirpath, shard)].append(os.path.join(dirpath, fname))
+    for folder_shard in sorted(shard_fpaths):
+        seen_pages = set()
+        for shard_fpath in sorted(shard_fpaths[folder_shard]):
+            for line in iter_gzip_lines(shard_fpath):
+                record = json.loads(line)
+                page = (record['website'], record['url'])
+                if page not in seen_pages:
+                    seen_pages.add(page)
+                    yield record
+
 
-        all_output = pd.concat((
-            read_csv_from_s3("statsnz-covid-xmiles", key) for key in output_keys
-        )).reset_index(drop=True)
-        all_output['Netloc'] = [parse.urlsplit(url).netloc for url in all_output['URL']]
-        print("Collected webpages")
-
-        websites = pd.DataFrame(
-            all_output.groupby('Netloc')['Text'].apply(' | '.join)
-        ).reset_index()
-        print("Collated websites")
-        websites['Counts'] = websites['Text'].map(get_word_counts)
-        print("Word counts obtained")
-        
-#         csv_list = [websites.columns.tolist()] + websites.values.tolist()
-#         write_to_csv_s3(csv_list, bucket, site_agg_key)
-        print(websites.head())
+def iter_gzip_lines(fpath):
+    """
+    Yield the complete lines of a gzipped text file. A file that is truncated
+    (e.g. its crawl was killed while it was being written) is read up to the
+    last complete line rather than raising an error.
+    """
+    with gzip.open(fpath, 'rt') as f:
+        try:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # incomplete last line
+                yield line
+        except EOFError:
+            print(f"{fpath} is truncated, only read the complete lines")
+
+
+def get_sparse_word_counts(text_chunks, analyzer):
+    """
+    Tokenise chunks of (netlocs, texts) into a sparse website x word count
+    matrix. The vocabulary is grown as new words are seen, so neither the
+    whole corpus nor per-website Counter dicts need to be held in memory.
+    
+    Returns netlocs (in row order), vocabulary (word -> column index) and the
+    CSR count matrix.
+    """
+    netloc_to_idx = {}
+    vocabulary = {}
+    row_parts, col_parts, count_parts = [], [], []
+    for netlocs, texts in text_chunks:
+        rows, cols, counts = array('i'), array('i'), array('i')
+        for netloc, text in zip(netlocs, texts):
+            site_idx = netloc_to_idx.setdefault(netloc, len(netloc_to_idx))
+            for word, count in Counter(analyzer(text)).items():
+                rows.append(site_idx)
+                cols.append(vocabulary.setdefault(word, len(vocabulary)))
+                counts.append(count)
+        # Merge the pages of each website within the chunk before storing
+        chunk_counts = sp.coo_matrix(
+            (np.frombuffer(counts, dtype=np.int32),
+             (np.frombuffer(rows, dtype=np.int32), np.frombuffer(cols, dtype=np.int32))),
+            shape=(len(netloc_to_idx), len(vocabulary))
+        ).tocsr().tocoo()
+        row_parts.append(chunk_counts.row)
+        col_parts.append(chunk_counts.col)
+        count_parts.append(chunk_counts.data)
+    
+    # Duplicate (website, word) entries across chunks are summed by tocsr().
+    # The empty arrays are for when there were no chunks at all.
+    row_parts.append(np.empty(0, dtype=np.int32))
+    col_parts.append(np.empty(0, dtype=np.int32))
+    count_parts.append(np.empty(0, dtype=np.int32))
+    word_counts = sp.coo_matrix(
+        (np.concatenate(count_parts), (np.concatenate(row_parts), np.concatenate(col_parts))),
+        shape=(len(netloc_to_idx), len(vocabulary))
+    ).tocsr()
+    print(f"Word counts obtained ({word_counts.shape[0]} websites, "
+          f"{word_counts.shape[1]} unique words)")
+    
+    return list(netloc_to_idx), vocabulary, word_counts
+
+
+def load_websites_tfidf(batch, bucket):
+    analyzer = TfidfVectorizer(stop_words='english').build_analyzer()
+    netlocs, vocabulary, word_counts = get_sparse_word_counts(
+        iter_website_text_chunks(batch, bucket), analyzer
+    )
+    if not netlocs:
+        raise ValueError(f"No website text found for {batch}")
+    # Insertion order of the vocabulary is the same as the column order
+    vocabulary_words = np.array(list(vocabulary), dtype=object)
+    X = TfidfTransformer().fit_transform(word_counts)
+    print("Tfidf values obtained")
     
     check_memory()
-    return websites
+    return netlocs, vocabulary_words, word_counts, X
+
+
+# Artifact functions
+def save_sparse_npy(folder, name, matrix):
+    """
+    Save the components of a CSR matrix as separate .npy files, so that they
+    can be memory-mapped when reloaded (unlike scipy's compressed .npz).
+    """
+    np.save(os.path.join(folder, f"{name}_data.npy"), matrix.data)
+    np.save(os.path.join(folder, f"{name}_indices.npy"), matrix.indices)
+    np.save(os.path.join(folder, f"{name}_indptr.npy"), matrix.indptr)
+    np.save(os.path.join(folder, f"{name}_shape.npy"), np.array(matrix.shape))
+
+
+def load_sparse_npy(folder, name):
+    components = [
+        np.load(os.path.join(folder, f"{name}_{part}.npy"), mmap_mode='r')
+        for part in ['data', 'indices', 'indptr']
+    ]
+    shape = tuple(np.load(os.path.join(folder, f"{name}_shape.npy")))
+    return sp.csr_matrix(tuple(components), shape=shape, copy=False)
+
+
+def save_word_list(folder, name, words):
+    """
+    Save a list of words as the concatenation of their UTF-8 bytes plus an
+    offsets array, both .npy so they can be memory-mapped when reloaded. (A
+    numpy str array would be fixed-width, so one long word would set the size
+    of every entry.)
+    """
+    encoded_words = [word.encode() for word in words]
+    offsets = np.zeros(len(encoded_words) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded_words], out=offsets[1:])
+    np.save(os.path.join(folder, f"{name}_bytes.npy"),
+            np.frombuffer(b''.join(encoded_words), dtype=np.uint8))
+    np.save(os.path.join(folder, f"{name}_offsets.npy"), offsets)
+
+
+class WordList:
+    """
+    Memory-mapped list of words saved by save_word_list(). Can be indexed with
+    an int (returns a str), or a slice or array of ints (returns a list of
+    str).
+    """
+    def __init__(self, folder, name):
+        self.data = np.load(os.path.join(folder, f"{name}_bytes.npy"), mmap_mode='r')
+        self.offsets = np.load(os.path.join(folder, f"{name}_offsets.npy"), mmap_mode='r')
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if np.ndim(idx) > 0:
+            return [self[i] for i in idx]
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode()
+
+
+def save_cluster_artifacts(folder, netlocs, km_labels, vocabulary_words, word_counts, X):
+    """
+    Save everything needed to redraw the cluster wordclouds in compact binary
+    formats (.npy), which avoids re-parsing CSVs and re-vectorising the text.
+    """
+    save_word_list(folder, "netlocs", netlocs)
+    np.save(os.path.join(folder, "km_clusters.npy"), km_labels.astype('uint8'))
+    save_word_list(folder, "vocabulary", vocabulary_words)
+    save_sparse_npy(folder, "word_counts", word_counts)
+    save_sparse_npy(folder, "tfidf", X)
+    print("Saved cluster artifacts")
+
+
+def cluster_artifacts_exist(folder):
+    return all(os.path.exists(os.path.join(folder, fname))
+               for fname in ["tfidf_shape.npy", "vocabulary_offsets.npy", "netlocs_offsets.npy"])
+
+
+def load_cluster_artifacts(folder):
+    netlocs = WordList(folder, "netlocs")
+    km_labels = np.load(os.path.join(folder, "km_clusters.npy"), mmap_mode='r')
+    vocabulary_words = WordList(folder, "vocabulary")
+    word_counts = load_sparse_npy(folder, "word_counts")
+    X = load_sparse_npy(folder, "tfidf")
+    print("Loaded cluster artifacts")
+    
+    return netlocs, km_labels, vocabulary_words, word_counts, X
+
+
+# Wordcloud functions
+def get_cluster_top_words(X, labels, n_clusters, vocabulary_words, top_n=100):
+    """
+    Find the top_n words (by tfidf value, normalised within each cluster) for
+    every cluster at once. The tfidf values are summed per cluster with a
+    single sparse product between a cluster indicator matrix and X, so the
+    cost scales with the number of non-zero tfidf values rather than with
+    clusters x websites.
+    
+    Returns the number of websites in each cluster and a word->tfidf dict for
+    each cluster.
+    """
+    n_sites = X.shape[0]
+    cluster_indicator = sp.csr_matrix(
+        (np.ones(n_sites), (labels.astype(np.int64), np.arange(n_sites))),
+        shape=(n_clusters, n_sites)
+    )
+    cluster_sizes = np.asarray(cluster_indicator.sum(axis=1)).ravel().astype(int)
+    tfidf_per_cluster = (cluster_indicator @ X).tocsr()
+    norm_factors = np.asarray(tfidf_per_cluster.sum(axis=1)).ravel()
+    
+    cluster_word_tfidfs = []
+    for i in range(n_clusters):
+        row_start, row_end = tfidf_per_cluster.indptr[i], tfidf_per_cluster.indptr[i + 1]
+        word_idxs = tfidf_per_cluster.indices[row_start:row_end]
+        tfidfs = tfidf_per_cluster.data[row_start:row_end] / (norm_factors[i] or 1)
+        # Only the non-zero words in the cluster are partitioned
+        if len(tfidfs) > top_n:
+            top_n_idxs = np.argpartition(tfidfs, -top_n)[-top_n:]
+            word_idxs, tfidfs = word_idxs[top_n_idxs], tfidfs[top_n_idxs]
+        cluster_word_tfidfs.append(dict(zip(vocabulary_words[word_idxs], tfidfs.tolist())))
+    
+    return cluster_sizes, cluster_word_tfidfs
+
+
+def render_wordcloud(word_to_tfidf):
+    """
+    Run in a worker process, so returns the image array rather than the
+    WordCloud object. Returns None for an empty cluster.
+    """
+    if not word_to_tfidf:
+        return None
+    return WordCloud(width=1800, height=1200).generate_from_frequencies(word_to_tfidf).to_array()
 
     
 def get_cluster_wclouds(batch, bucket, n_clusters, seed):
@@ -167,30 +423,21 @@ def get_cluster_wclouds(batch, bucket, n_clusters, seed):
         os.makedirs(output_folder)
     
     clustered_sites_fpath = os.path.join(output_folder, "clustered_websites.csv")
-    if os.path.exists(clustered_sites_fpath):
-        websites = pd.read_csv(clustered_sites_fpath,
-                               dtype={'KM_cluster': 'uint8'})
-        # Convert dict-style string into dict object
-        websites['Counts'] = [json.loads(counts_str.replace("'", '"'))
-                              for counts_str in websites['Counts']]
-        print("Loaded clustered websites from EC2")
-        
-        vectorizer = TfidfVectorizer(stop_words='english') # for getting cluster wclouds
-        X = vectorizer.fit_transform(websites['Text'])
-        print("Tfidf values obtained")
+    if cluster_artifacts_exist(output_folder):
+        netlocs, km_labels, vectorizer_words, word_counts, X = load_cluster_artifacts(output_folder)
     else:
-        websites = load_websites_df(batch, bucket)
-
-        vectorizer = TfidfVectorizer(stop_words='english')
-        X = vectorizer.fit_transform(websites['Text'])
-        print("Tfidf values obtained")
-        km = KMeans(n_clusters=n_clusters, init='k-means++', random_state=seed).fit(X)
-        websites['KM_cluster'] = km.labels_.astype('uint8')
+        netlocs, vectorizer_words, word_counts, X = load_websites_tfidf(batch, bucket)
+        # Mini-batch updates keep the clustering cost proportional to the
+        # batch size rather than the number of websites.
+        km = MiniBatchKMeans(n_clusters=n_clusters, init='k-means++',
+                             batch_size=KM_BATCH_SIZE, random_state=seed).fit(X)
+        km_labels = km.labels_.astype('uint8')
         print("Clustered websites")
-        websites.to_csv(clustered_sites_fpath)
+        save_cluster_artifacts(output_folder, netlocs, km_labels, vectorizer_words, word_counts, X)
+        # CSV copy is only for looking at, the artifacts are used for reruns
+        pd.DataFrame({'Netloc': netlocs, 'KM_cluster': km_labels}).to_csv(clustered_sites_fpath)
     
-    vectorizer_words = np.array(vectorizer.get_feature_names())
-    print(websites.head())
+    print(pd.DataFrame({'Netloc': netlocs[:5], 'KM_cluster': km_labels[:5]}))
     check_memory()
     
     current_dt = (datetime.now() + timedelta(hours=12)).strftime("%Y%m%d%H%M%S") # add 12hrs for timezone
@@ -207,49 +454,23 @@ def get_cluster_wclouds(batch, bucket, n_clusters, seed):
         else:
             ax[i].set_visible(False)  # make unused axes invisible
             
-    for i in range(n_clusters):
-        cluster_tstart = datetime.now()
-        print(f"Wordcloud #{i + 1}, ", end="", flush=True)
-#         cluster_websites = websites[websites['KM_cluster'] == i]
-#         print(f"Includes {cluster_websites.shape[0]} websites, ", end="", flush=True)
-        
-        # ORIGINAL METHOD using each word's frequency averaged across documents - VERY SLOW
-#         # avg_word_freqs are saved in pickle format for later retrieval
-#         avg_word_freqs_fpath = os.path.join("data", f"avg_word_freqs_cluster{i + 1}.p")
-#         if os.path.exists(avg_word_freqs_fpath):
-#             with open(avg_word_freqs_fpath, 'rb') as fp:
-#                 avg_word_freqs = pickle.load(fp)
-#             print(f"Includes {len(avg_word_freqs)} unique words, ", end="", flush=True)
-#         else:
-#             avg_word_freqs = get_avg_word_freqs(cluster_websites, stops)
-#             with open(avg_word_freqs_fpath, 'wb') as fp:
-#                 pickle.dump(avg_word_freqs, fp, protocol=pickle.HIGHEST_PROTOCOL)
-#         cluster_wcloud = WordCloud(width=1800, height=1200, collocations=False).generate_from_frequencies(avg_word_freqs)
-
-        # NEW METHOD using each word's tfidf values
-        TOP_N = 100
-        cluster_idx = websites[websites['KM_cluster'] == i].index.tolist()
-        norm_factor = X[cluster_idx, :].sum()
-        tfidf_per_word = X[cluster_idx, :].sum(axis=0) / norm_factor
-        # Get indices of the top 'n' tfidf values:
-        top_n_tfidf_idxs = np.argpartition(tfidf_per_word, -TOP_N)[:, -TOP_N:].tolist()[0]
-        word_to_tfidf = {
-            word: tfidf for word, tfidf in 
-            zip(vectorizer_words[top_n_tfidf_idxs], tfidf_per_word[:, top_n_tfidf_idxs].tolist()[0])
-        }
-        cluster_wcloud = WordCloud(width=1800, height=1200).generate_from_frequencies(word_to_tfidf)
-        
-        ax[i].imshow(cluster_wcloud)
-        ax[i].set(title=f"KMeans Cluster #{i + 1} - {len(cluster_idx)} website(s)")
-        
-        cluster_tdelta = datetime.now() - cluster_tstart
-        print(f"Plotted, Time taken: {cluster_tdelta}")
-        if i < (n_clusters - 1):
-            plt.savefig(os.path.join(output_folder, f"km_wclouds-WIP{i + 1}.jpeg"))
-            
-        else:
-            plt.savefig(os.path.join(output_folder, "km_wclouds-FINAL.jpeg"))
-            print("Finished")
+    tstart = datetime.now()
+    cluster_sizes, cluster_word_tfidfs = get_cluster_top_words(
+        X, np.asarray(km_labels), n_clusters, vectorizer_words
+    )
+    print(f"Got top words for all clusters, Time taken: {datetime.now() - tstart}")
+    
+    tstart = datetime.now()
+    with ProcessPoolExecutor() as executor:
+        cluster_wclouds = list(executor.map(render_wordcloud, cluster_word_tfidfs))
+    for i, (cluster_wcloud, cluster_size) in enumerate(zip(cluster_wclouds, cluster_sizes)):
+        if cluster_wcloud is not None:
+            ax[i].imshow(cluster_wcloud)
+        ax[i].set(title=f"KMeans Cluster #{i + 1} - {cluster_size} website(s)")
+    print(f"Plotted wordclouds, Time taken: {datetime.now() - tstart}")
+    
+    plt.savefig(os.path.join(output_folder, "km_wclouds-FINAL.jpeg"))
+    print("Finished")
 
             
 if __name__ == "__main__":